@@ -1,10 +1,110 @@
 #!/usr/bin/env python
 
-from zipfile import ZipFile,ZipInfo
+from zipfile import ZipFile,ZipInfo,ZIP_DEFLATED
 import time
 import os
+import stat
+import struct
 import sys
 import gzip
+import io
+import mmap
+import errno
+import shutil
+import subprocess
+
+# Size of the buffers wrapped around compressed streams, so that zlib is handed
+# large chunks rather than many small reads and writes.
+READ_BUFFER_SIZE = 128*1024
+
+# External programs preferred over the gzip module, in order of preference.
+# They run zlib in another process (pigz across several threads, even).
+GZIP_PROGRAMS = ["pigz", "gzip"]
+
+# Lines of a Vimball that end its vimscript header and start each file.
+# Python 2 strings are bytes, so the parser never decodes anything.
+FINISH = "finish\n"
+FILEMARKER = "\t[[[1\n"
+FILEMARKER_LEN = len(FILEMARKER)
+
+# Formats whose archives are copied byte for byte when converted to themselves
+PASSTHROUGH_EXTS = ["vba", "vba.gz"]
+
+# Defaults for new ArchiveMembers, computed once rather than per member.
+# Reading the umask means briefly resetting it, so do that just once here.
+UMASK = os.umask(0)
+os.umask(UMASK)
+DEFAULT_PERM = 0666 & ~UMASK
+DEFAULT_MTIME = time.localtime(time.time())[:6]
+
+class GzipPipe(object):
+  """
+  Present the stdio pipe of an external gzip process as a file object.
+  """
+
+  def __init__(self, process, pipe):
+    self.process = process
+    self.pipe = pipe
+
+  def read(self, size=-1):
+    data = self.pipe.read(size)
+    if size < 0 or not data:
+      self.wait() # EOF could mean the process failed part way through
+    return data
+
+  def write(self, data):
+    self.pipe.write(data)
+
+  def writelines(self, lines):
+    self.pipe.writelines(lines)
+
+  def close(self):
+    self.pipe.close()
+    self.wait()
+
+  def wait(self):
+    status = self.process.wait()
+    if status != 0:
+      raise IOError("gzip process exited with status %d" % status)
+
+def openGzipped(archivepath, mode):
+  """
+  Open the gzipped file at archivepath for reading ('rb') or writing ('wb').
+
+  Uses the first of GZIP_PROGRAMS that can be run, and falls back on the gzip
+  module when none of them are installed.
+  """
+  if mode == 'rb':
+    file = open(archivepath, 'rb')
+    args = ["-dc"]
+    streams = { "stdin" : file, "stdout" : subprocess.PIPE }
+  else:
+    file = open(archivepath, 'wb')
+    args = ["-c"]
+    streams = { "stdin" : subprocess.PIPE, "stdout" : file }
+
+  try:
+    for program in GZIP_PROGRAMS:
+      try:
+        process = subprocess.Popen([program] + args, bufsize=READ_BUFFER_SIZE,
+                                   **streams)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+        continue # Not installed, try the next one
+      if mode == 'rb':
+        return GzipPipe(process, process.stdout)
+      else:
+        return GzipPipe(process, process.stdin)
+  finally:
+    file.close() # The child process has its own copy
+
+  if mode == 'rb':
+    return io.BufferedReader(gzip.open(archivepath, mode),
+                             buffer_size=READ_BUFFER_SIZE)
+  else:
+    return io.BufferedWriter(gzip.open(archivepath, mode),
+                             buffer_size=READ_BUFFER_SIZE)
 
 class ArchiveMember(object):
   """
@@ -13,45 +113,90 @@ class ArchiveMember(object):
   The following attributes will be supported:
   name		Name of the member (must be provided)
   data		Contents of the member (default empty)
-  mtime		Time of last modification (default current time)
-  perm		Unix-style permissions for the member (default 0666)
+  path		File holding the contents instead of data, read lazily (default None)
+  numlines	Number of lines in the contents, when already known (default None)
+  mtime		Time of last modification (default time the script started)
+  perm		Unix-style permissions for the member (default 0666 less umask)
   isdir		Checks the permissions to see if they have the directory bit
   """
 
-  def __init__(self, name):
+  __slots__ = ("name", "data", "path", "numlines", "_perm", "_isdir", "mtime")
+
+  def __init__(self, name, data=None, path=None, numlines=None,
+               perm=DEFAULT_PERM, mtime=DEFAULT_MTIME):
     """
     Construct an archive member with the given name.
 
-    Note: Not thread safe, because of setting/resetting umask!
+    Other attributes can be given as keyword arguments, so that readers can
+    build each member in one call instead of overwriting the defaults.
     """
-    umask = os.umask(0)
-    os.umask(umask)
     self.name = name
-    self.data = None
-    self.perm = 0666 & ~umask
-    self.mtime = time.localtime(time.time())[:6]
+    self.data = data
+    self.path = path
+    self.numlines = numlines
+    self.perm = perm
+    self.mtime = mtime
 
-  def __getattribute__(self, name):
-    if name == "isdir":
-      return object.__getattribute__(self, 'perm') & 040000 == 040000
-    else:
-      return object.__getattribute__(self, name)
+  def open(self):
+    """
+    Return a file object reading the contents of the member.
+    """
+    if self.path is not None:
+      return open(self.path, "rb")
+    return io.BytesIO(self.data or "")
 
-  def __setattr__(self, name, value):
-    if name == "isdir":
-      # Toggle directory and executable bits appropriately
-      if value:
-        self.__dict__["perm"] = self.__dict__["perm"] | 040111
-      else:
-        self.__dict__["perm"] = self.__dict__["perm"] & ~040111
+  def read(self):
+    """
+    Return the full contents of the member.
+    """
+    if self.path is None:
+      return self.data or ""
+    # Skip the buffered file object; read exactly the size of the file
+    fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+      size = os.fstat(fd).st_size
+      chunks = []
+      while size > 0:
+        chunk = os.read(fd, size)
+        if chunk == "":
+          break # Shrunk since we checked its size
+        chunks.append(chunk)
+        size -= len(chunk)
+      return "".join(chunks)
+    finally:
+      os.close(fd)
+
+  @property
+  def perm(self):
+    return self._perm
+
+  @perm.setter
+  def perm(self, value):
+    # Work out isdir now, since writers check it for every member
+    self._perm = value
+    self._isdir = value & 040000 == 040000
+
+  @property
+  def isdir(self):
+    return self._isdir
+
+  @isdir.setter
+  def isdir(self, value):
+    # Toggle directory and executable bits appropriately
+    if value:
+      self.perm = self.perm | 040111
     else:
-      self.__dict__[name] = value
+      self.perm = self.perm & ~040111
 
 class ArchiveReader(object):
   """
   Provide an interface for iterating over the members of an archive.
+
+  Subclasses set ext to the name of their format on the command line.
   """
 
+  ext = None
+
   def __init__(self, archivepath):
     """
     Prepare to read the members of the archive given by archivepath.
@@ -62,14 +207,20 @@ class ArchiveReader(object):
   def __iter__(self):
     """
     Generate an iterator over the members of this archive as ArchiveMembers.
+
+    Each member is a new object, so callers may hold on to them.
     """
     raise NotImplementedError
 
 class ArchiveWriter(object):
   """
   Provide an interface for adding members to an archive.
+
+  Subclasses set ext to the name of their format on the command line.
   """
 
+  ext = None
+
   def __init__(self, archivepath):
     """
     Prepare to write to the archive given by archivepath.
@@ -83,143 +234,262 @@ class ArchiveWriter(object):
     """
     raise NotImplementedError
 
+  def close(self):
+    """
+    Finish writing the archive, flushing anything still buffered.
+    """
+    pass
+
 class VimballReader(ArchiveReader):
   """ Provide an ArchiveReader for Vimball archives. """
 
-  def __init__(self, archivepath):
-    self.archive = open(archivepath, "r")
-
-  def __iter__(self):
-    filemarker = "\t[[[1\n"
-    files = {}
-    dirs = []
-    dirs_set = {}
-
-    line = None
-    while line != "" and line != "finish\n":
-      line = self.archive.readline()
-
-    while True:
-      file = self.archive.readline()
-
-      if file == '':
-        break # All files handled
-
-      if not file.endswith(filemarker):
-        raise "FIXME Bad Vimball"
-      file = file[:-len(filemarker)]
+  ext = "vba"
 
-      numlines = self.archive.readline().rstrip("\n")
-      if not numlines.isdigit():
-        raise "FIXME Bad Vimball!"
-
-      lines = ""
-      for i in range(int(numlines)):
-        line = self.archive.readline()
-        if line == '':
-          raise "FIXME Truncated Vimball"
-        lines += line
+  def __init__(self, archivepath):
+    self.archive = open(archivepath, "rb")
 
-      files[file] = lines
+  def contents(self):
+    """
+    Return the whole archive as a string, or something that slices like one.
 
-      dirs_set[os.path.dirname(file)] = None
-    dirs = dirs_set.keys()
-    dirs.sort()
+    Maps the file into memory, so scanning it doesn't copy it all first.
+    """
+    if os.fstat(self.archive.fileno()).st_size == 0:
+      return "" # Empty files can't be mapped
+    return mmap.mmap(self.archive.fileno(), 0, access=mmap.ACCESS_READ)
 
-    for dir in dirs:
-      member = ArchiveMember(dir)
-      member.isdir = True
-      yield member
+  def entries(self):
+    """
+    Generate (name, data, numlines) for each file in the archive, in order.
+    """
+    # Get the whole archive at once and slice the members out of it, rather
+    # than building each one up a line at a time.
+    buf = self.contents()
+    end = len(buf)
+
+    # Skip past the "finish" line ending the vimscript header.
+    if buf[:len(FINISH)] == FINISH:
+      pos = len(FINISH)
+    else:
+      pos = buf.find("\n" + FINISH)
+      if pos == -1:
+        pos = end
+      else:
+        pos += 1 + len(FINISH)
+
+    while pos < end:
+      nl = buf.find("\n", pos)
+      if nl == -1:
+        raise ValueError("Bad Vimball: unterminated file header")
+      file = buf[pos:nl + 1]
+
+      if not file.endswith(FILEMARKER):
+        raise ValueError("Bad Vimball: expected file header, got %r" % file)
+      file = file[:-FILEMARKER_LEN]
+
+      pos = nl + 1
+      nl = buf.find("\n", pos)
+      if nl == -1:
+        nl = end
+      try:
+        numlines = int(buf[pos:nl])
+      except ValueError:
+        numlines = -1
+      if numlines < 0:
+        raise ValueError("Bad Vimball: bad line count for %s" % file)
+
+      # Find where the body ends by hopping over numlines newlines; a final
+      # line without a trailing newline still counts as a line.
+      start = pos = nl + 1
+      if numlines > end - start:
+        # Every line takes at least a byte, so don't even start counting
+        raise ValueError("Bad Vimball: %s is truncated" % file)
+      for i in xrange(numlines):
+        if pos >= end:
+          raise ValueError("Bad Vimball: %s is truncated" % file)
+        nl = buf.find("\n", pos)
+        if nl == -1:
+          pos = end
+        else:
+          pos = nl + 1
+
+      yield (file, buf[start:pos], numlines)
 
-    for (file, data) in files.items():
-      member = ArchiveMember(file)
-      member.data = data
-      yield member
+  def __iter__(self):
+    dirs_seen = { "" : None }
+
+    for (file, data, numlines) in self.entries():
+      # Yield any directories this file is the first to be found in, parents
+      # before children, then the file itself
+      dirs = []
+      dir = os.path.dirname(file)
+      while dir not in dirs_seen:
+        dirs_seen[dir] = None
+        dirs.append(dir)
+        dir = os.path.dirname(dir)
+      dirs.reverse()
+
+      for dir in dirs:
+        member = ArchiveMember(dir)
+        member.isdir = True
+        yield member
+
+      yield ArchiveMember(file, data=data, numlines=numlines)
 
 class GzippedVimballReader(VimballReader):
   """ Extend the VimballReader to work on gzipped Vimballs. """
+
+  ext = "vba.gz"
+
   def __init__(self, archivepath):
-    self.archive = gzip.open(archivepath, 'r')
+    self.archive = openGzipped(archivepath, 'rb')
+
+  def contents(self):
+    return self.archive.read()
 
 class VimballWriter(ArchiveWriter):
+  ext = "vba"
+
   def __init__(self, archivepath):
-    self.archive = open(archivepath, 'w')
+    self.archive = open(archivepath, 'wb')
     self.header_written = False
 
   def add(self, member):
     if not self.header_written:
       self.archive.write("\" Vimball Archiver by Charles E. Campbell, Jr., Ph.D.\n"
                          "UseVimball\n"
-                         "finish\n")
+                         + FINISH)
       self.header_written = True
     if member.isdir:
       return # Can't create directories with a vimball
-    self.archive.write(member.name + "\t[[[1\n")
-    if member.data.endswith("\n"):
-      data = member.data
-    else:
-      data = member.data + "\n"
-    self.archive.write(str(data.count("\n")) + "\n")
-    self.archive.write(data)
+    data = member.read()
+    needs_newline = not data.endswith("\n")
+    numlines = member.numlines
+    if numlines is None:
+      numlines = data.count("\n") + needs_newline
+    elif not data:
+      numlines = 1 # Written out as a single empty line
+    # Hand the whole member to the archive at once
+    parts = [member.name, FILEMARKER, str(numlines), "\n", data]
+    if needs_newline:
+      parts.append("\n") # Append it rather than copy data to add it
+    self.archive.writelines(parts)
+
+  def close(self):
+    self.archive.close()
 
 class GzippedVimballWriter(VimballWriter):
+  ext = "vba.gz"
+
   def __init__(self, archivepath):
-    self.archive = gzip.open(archivepath, 'w')
+    self.archive = openGzipped(archivepath, 'wb')
     self.header_written = False
 
 class ZipWriter(ArchiveWriter):
   """ Provide an ArchiveWriter for zip archives. """
 
+  ext = "zip"
+
   def __init__(self, archivepath):
-    self.archive = ZipFile(archivepath, "w")
+    # zipfile deflates at zlib's default level 6, not the slower maximum of 9
+    self.archive = ZipFile(archivepath, "w", ZIP_DEFLATED, allowZip64=True)
 
   def add(self, member):
     if (member.isdir):
       return # FIXME Should be able to add empty directories
-    info = ZipInfo(member.name)
-    info.date_time = member.mtime
-    info.external_attr = member.perm << 16L
-    self.archive.writestr(info, member.data)
+    if member.path is not None:
+      # Let zipfile stream it from disk rather than holding it all in memory,
+      # then replace the mtime and permissions it took from the file with the
+      # member's own if they differ.
+      self.archive.write(member.path, member.name)
+      info = self.archive.filelist[-1]
+      info.external_attr = member.perm << 16L
+      if info.date_time != tuple(member.mtime):
+        self.redate(info, member.mtime)
+      return
+    self.writestr(member.name, member.read(), member.perm, member.mtime)
+
+  def redate(self, info, date_time):
+    """
+    Change the mtime of the member the archive has just written for info.
+
+    The central directory is written from info on close, but its local header
+    is already on disk, so patch the DOS time and date there as well.  This
+    relies on the internals of Python 2.7's zipfile: ZipFile.fp, the header
+    offset ZipFile.write records, and the local header keeping those fields
+    10 bytes in, packed the way ZipInfo.FileHeader packs them.
+    """
+    info.date_time = date_time
+    dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+
+    end = self.archive.fp.tell()
+    self.archive.fp.seek(info.header_offset + 10)
+    self.archive.fp.write(struct.pack("<HH", dostime, dosdate))
+    self.archive.fp.seek(end)
+
+  def writestr(self, name, data, perm, mtime):
+    """
+    Add a file with the given contents, permissions and mtime to the archive.
+    """
+    info = ZipInfo(name)
+    info.date_time = mtime
+    info.external_attr = perm << 16L
+    info.compress_type = ZIP_DEFLATED # ZipInfo defaults to storing
+    self.archive.writestr(info, data)
+
+  def close(self):
+    self.archive.close()
 
 class DirectoryReader(ArchiveReader):
   """ Provide an ArchiveReader for filesystem directories. """
 
+  ext = "dir"
+
   def __init__(self, archivepath):
     self.archivepath = os.path.normpath(archivepath)
-    self.filenames = []
-    self.dirnames = []
+    self.files = []
+    self.dirs = []
+
+    self.scan("", self.archivepath)
 
-    for tuple in os.walk(self.archivepath):
-      dir = tuple[0][len(self.archivepath)+1:]
-      for dirname in tuple[1]:
-        self.dirnames.append(os.path.join(dir, dirname))
-      for filename in tuple[2]:
-        self.filenames.append(os.path.join(dir, filename))
+  def scan(self, dir, path):
+    """
+    Record everything below dir, found on disk at path, stat'ing each once.
+
+    Directories are recorded as (name, statbuf) and files as (name, path,
+    statbuf), so nothing needs joining again later.  Like os.walk, symlinks to
+    directories are listed but not descended into.
+    """
+    for filename in os.listdir(path):
+      name = os.path.join(dir, filename)
+      fullpath = os.path.join(path, filename)
+      statbuf = os.lstat(fullpath)
+      if stat.S_ISDIR(statbuf.st_mode):
+        self.dirs.append((name, statbuf))
+        self.scan(name, fullpath)
+        continue
+      if stat.S_ISLNK(statbuf.st_mode):
+        statbuf = os.stat(fullpath)
+      if stat.S_ISDIR(statbuf.st_mode):
+        self.dirs.append((name, statbuf))
+      else:
+        self.files.append((name, fullpath, statbuf))
 
   def __iter__(self):
-    for directory in self.dirnames:
-      name = os.path.join(self.archivepath, directory)
-      statbuf = os.stat(name)
-
-      member = ArchiveMember(directory)
-      member.perm = statbuf.st_mode
-      member.mtime = statbuf.st_mtime
-      yield member
-    for filename in self.filenames:
-      name = os.path.join(self.archivepath, filename)
-      statbuf = os.stat(name)
-
-      member = ArchiveMember(filename)
-      member.perm = statbuf.st_mode
-      member.mtime = statbuf.st_mtime
-
-      file = open(os.path.join(self.archivepath, filename), "rb")
-      member.data = file.read()
-      yield member
+    for (directory, statbuf) in self.dirs:
+      yield ArchiveMember(directory, perm=statbuf.st_mode,
+                          mtime=time.localtime(statbuf.st_mtime)[:6])
+    for (filename, fullpath, statbuf) in self.files:
+      yield ArchiveMember(filename, perm=statbuf.st_mode,
+                          mtime=time.localtime(statbuf.st_mtime)[:6],
+                          path=fullpath)
 
 class DirectoryWriter(ArchiveWriter):
   """ Provide an ArchiveWriter for filesystem directories. """
 
+  ext = "dir"
+
   def __init__(self, archivepath):
     self.archivepath = os.path.normpath(archivepath)
 
@@ -233,14 +503,36 @@ class DirectoryWriter(ArchiveWriter):
     if (member.isdir):
       os.mkdir(path, member.perm)
     else:
-      file = open(path, "wb")
-      file.write(member.data)
-      file.close()
+      src = member.open()
+      try:
+        file = open(path, "wb")
+        try:
+          shutil.copyfileobj(src, file, READ_BUFFER_SIZE)
+        finally:
+          file.close()
+      finally:
+        src.close()
+
+# Readers and writers for each format named on the command line, by their ext
+READERS = dict((cls.ext, cls) for cls in
+               (VimballReader, GzippedVimballReader, DirectoryReader))
+WRITERS = dict((cls.ext, cls) for cls in
+               (ZipWriter, DirectoryWriter, VimballWriter, GzippedVimballWriter))
 
 def archiveConvert(read_mgr, write_mgr):
   for member in read_mgr:
     write_mgr.add(member)
 
+def vimballToZip(read_mgr, write_mgr):
+  """
+  Add each file of the VimballReader read_mgr to the ZipWriter write_mgr.
+
+  Does the same as archiveConvert for this pair, but hands each file straight
+  to the zip archive rather than building an ArchiveMember for it first.
+  """
+  for (file, data, numlines) in read_mgr.entries():
+    write_mgr.writestr(file, data, DEFAULT_PERM, DEFAULT_MTIME)
+
 def usage():
   print "usage" # FIXME
   sys.exit()
@@ -267,27 +559,21 @@ if __name__ == '__main__':
   if split[1] != "2":
     usage()
 
-  reader = None
-  writer = None
+  if split[0] == split[2] and split[0] in PASSTHROUGH_EXTS:
+    # Nothing to convert, so don't parse and rewrite every member
+    shutil.copyfile(argv[0], argv[1])
+    sys.exit()
 
-  if split[0] == "vba":
-    reader = VimballReader(argv[0])
-  elif split[0] == "vba.gz":
-    reader = GzippedVimballReader(argv[0])
-  elif split[0] == "dir":
-    reader = DirectoryReader(argv[0])
-  else:
+  if split[0] not in READERS:
     raise NotImplementedError("No such reader: " + split[0])
+  reader = READERS[split[0]](argv[0])
 
-  if split[2] == "zip":
-    writer = ZipWriter(argv[1])
-  elif split[2] == "dir":
-    writer = DirectoryWriter(argv[1])
-  elif split[2] == "vba":
-    writer = VimballWriter(argv[1])
-  elif split[2] == "vba.gz":
-    writer = GzippedVimballWriter(argv[1])
-  else:
+  if split[2] not in WRITERS:
     raise NotImplementedError("No such writer: " + split[2])
+  writer = WRITERS[split[2]](argv[1])
 
-  archiveConvert(reader, writer)
+  if isinstance(reader, VimballReader) and isinstance(writer, ZipWriter):
+    vimballToZip(reader, writer)
+  else:
+    archiveConvert(reader, writer)
+  writer.close()